@@ -4,87 +4,259 @@
 # found in the LICENSE file.
 
 import argparse
+import concurrent.futures
 import configparser
+import dataclasses
+import email.utils
+import functools
+import hashlib
+import importlib.util
+import multiprocessing
 import os
 import pathlib
 import re
+import shutil
 import stat
 import subprocess
+import sys
 import tempfile
 import threading
 import time
+import types
+import urllib.error
 import urllib.request
 
+try:
+  import pyudev
+except ImportError:
+  pyudev = None
+
+_INI_DEFAULTS = types.MappingProxyType({
+  'kernel_part_uuid': None,
+  'root_uuid': None,
+  'defconfig': None,
+  'config_file': None,
+  'jobs': None,
+  'vbutil_kernel': None,
+  'keyblock': None,
+  'data_key': None,
+  'cmdline': None,
+  'vbutil_arch': None,
+  'mkimage': None,
+  'its_file': None,
+  'completion_text': None,
+  'install_headers': 'no',
+  'ccache': None,
+  'ccache_dir': None,
+  'load_avg': None,
+})
+
+# Keyed on mtime/size as well as path so an edited ini is re-parsed. Callers
+# must treat the returned parser as read-only since it is shared.
+@functools.lru_cache(maxsize=32)
+def _load_cp(path, mtime_ns, size):
+  cp = configparser.ConfigParser(defaults=dict(_INI_DEFAULTS),
+                                 allow_no_value=True)
+  cp.read(path)
+  return cp
+
+# ARCH values that don't match their arch/ directory, as mapped by Kbuild
+_SRCARCH = {
+  'i386': 'x86',
+  'x86_64': 'x86',
+  'sparc32': 'sparc',
+  'sparc64': 'sparc',
+  'sh64': 'sh',
+  'parisc64': 'parisc',
+}
+
+# Respects any affinity mask/cpuset we were started with, unlike cpu_count()
+def _default_jobs():
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+# (major, minor) of the host's GNU make, which make.cross runs, or None
+@functools.lru_cache(maxsize=None)
+def _make_version():
+  try:
+    out = subprocess.run(['make', '--version'], stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL,
+                         universal_newlines=True).stdout
+  except OSError:
+    return None
+  m = re.match(r'GNU Make (\d+)\.(\d+)', out)
+  return (int(m.group(1)), int(m.group(2))) if m else None
+
+# --output-sync first appeared in GNU make 4.0
+def _make_supports_output_sync():
+  version = _make_version()
+  return bool(version) and version >= (4, 0)
+
+_MAKE_CROSS_URL = ('https://raw.githubusercontent.com/intel/lkp-tests/'
+                   'master/sbin/make.cross')
+_MAKE_CROSS_MAX_AGE = 24 * 60 * 60
+
+# Only hits the network if the local copy is over a day old, and then only
+# rewrites it if upstream has changed since it was fetched
+def _download_make_cross(path='make.cross'):
+  headers = {}
+  fresh = False
+  if os.path.exists(path):
+    mtime = os.path.getmtime(path)
+    fresh = time.time() - mtime < _MAKE_CROSS_MAX_AGE
+    headers['If-Modified-Since'] = email.utils.formatdate(mtime, usegmt=True)
+
+  if not fresh:
+    req = urllib.request.Request(_MAKE_CROSS_URL, headers=headers)
+    try:
+      with urllib.request.urlopen(req) as resp:
+        data = resp.read()
+    except urllib.error.HTTPError as e:
+      if e.code != 304:
+        raise
+      os.utime(path)
+    else:
+      tmp_path = path + '.tmp'
+      with open(tmp_path, 'wb') as f:
+        f.write(data)
+      os.replace(tmp_path, path)
+
+  st = os.stat(path)
+  if not st.st_mode & stat.S_IEXEC:
+    os.chmod(path, st.st_mode | stat.S_IEXEC)
+
+_make_cross_lock = threading.Lock()
+_make_cross_future = None
+
+# Starts fetching make.cross in the background, once per process. Builders
+# kick this off from __init__ so the download overlaps with the rest of setup
+# and is waited on in do_build.
+def _prefetch_make_cross():
+  global _make_cross_future
+  with _make_cross_lock:
+    if _make_cross_future is None:
+      executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+      _make_cross_future = executor.submit(_download_make_cross)
+      executor.shutdown(wait=False)
+    return _make_cross_future
+
+# Everything a Builder reads from its ini file, parsed and typed once
+@dataclasses.dataclass(frozen=True)
+class BuildSpec(object):
+  kernel_part_uuid: str
+  root_uuid: str
+  defconfig: str
+  config_file: str
+  kernel_arch: str
+  compiler: str
+  compiler_install: str
+  jobs: int
+  load_avg: float
+  vbutil_kernel: str
+  keyblock: str
+  data_key: str
+  cmdline: str
+  vbutil_arch: str
+  mkimage: str
+  its_file: str
+  install_modules: bool
+  install_dtbs: bool
+  install_headers: bool
+  generate_htmldocs: bool
+  completion_text: str
+  ccache: str
+  ccache_dir: str
+
+  @classmethod
+  def from_file(cls, ini_path, jobs=None):
+    st = os.stat(ini_path)
+    cp = _load_cp(os.path.abspath(ini_path), st.st_mtime_ns, st.st_size)
+    return cls.from_config(cp, jobs)
+
+  @classmethod
+  def from_config(cls, cp, jobs=None):
+    tgt = dict(cp.items('target', raw=True))
+    bld = dict(cp.items('build', raw=True))
+
+    def getboolean(key):
+      value = bld[key]
+      if value.lower() not in cp.BOOLEAN_STATES:
+        raise ValueError('Not a boolean: {}'.format(value))
+      return cp.BOOLEAN_STATES[value.lower()]
+
+    def getuuid(key):
+      return tgt[key].lower() if tgt[key] else tgt[key]
+
+    if not jobs:
+      jobs = int(bld['jobs']) if bld['jobs'] else _default_jobs()
+
+    # Let make hold off starting jobs on a loaded machine, with enough headroom
+    # that jobs blocked on IO don't leave CPUs idle
+    load_avg = float(bld['load_avg']) if bld['load_avg'] else jobs * 1.5
+
+    # Use ccache whenever it's installed unless the config opts out
+    ccache = None
+    if bld['ccache'] is None or getboolean('ccache'):
+      ccache = shutil.which('ccache')
+      if not ccache and bld['ccache'] is not None:
+        raise ValueError('ccache is enabled but not installed')
+
+    return cls(kernel_part_uuid=getuuid('kernel_part_uuid'),
+               root_uuid=getuuid('root_uuid'),
+               defconfig=bld['defconfig'],
+               config_file=bld['config_file'],
+               kernel_arch=bld['kernel_arch'],
+               compiler=bld['compiler'],
+               compiler_install=bld['compiler_install'],
+               jobs=jobs,
+               load_avg=load_avg,
+               vbutil_kernel=bld['vbutil_kernel'],
+               keyblock=bld['keyblock'],
+               data_key=bld['data_key'],
+               cmdline=bld['cmdline'],
+               vbutil_arch=bld['vbutil_arch'],
+               mkimage=bld['mkimage'],
+               its_file=bld['its_file'],
+               install_modules=getboolean('install_modules'),
+               install_dtbs=getboolean('install_dtbs'),
+               install_headers=getboolean('install_headers'),
+               generate_htmldocs=getboolean('generate_htmldocs'),
+               completion_text=cp.get('build', 'completion_text'),
+               ccache=ccache,
+               ccache_dir=bld['ccache_dir'])
+
 class Builder(object):
 
-  stderr_ignore = [
-    re.compile('#warning syscall (io_pgetevents|rseq) not implemented'),
-  ]
+  # Extend with '|(?:...)' rather than adding a separate pattern so each
+  # stderr line is matched with a single search
+  stderr_ignore_re = re.compile(
+    rb'(?:#warning syscall (io_pgetevents|rseq) not implemented)'
+  )
+
+  _drm_re = re.compile(rb'(?:drivers/gpu/drm|include/drm|include/uapi/drm)')
+
+  pipe_chunk_size = 64 * 1024
 
   def __init__(self, ini_path, generate_compile_db, generate_pkg,
-               fail_on_stderr, kselftest=False):
-    cp = configparser.SafeConfigParser(
-            defaults={'kernel_part_uuid': None,
-                      'root_uuid': None,
-                      'defconfig': None,
-                      'config_file': None,
-                      'jobs': '1',
-                      'vbutil_kernel': None,
-                      'keyblock': None,
-                      'data_key': None,
-                      'cmdline': None,
-                      'vbutil_arch': None,
-                      'mkimage': None,
-                      'its_file': None,
-                      'completion_text': None,
-                      'install_headers': 'no',
-            }, allow_no_value=True)
-    cp.read(ini_path)
-
-    self.kernel_part_uuid = cp.get('target', 'kernel_part_uuid', raw=True)
-    if self.kernel_part_uuid:
-        self.kernel_part_uuid = self.kernel_part_uuid.lower()
-
-    self.root_uuid = cp.get('target', 'root_uuid', raw=True)
-    if self.root_uuid:
-        self.root_uuid = self.root_uuid.lower()
-
-    self.defconfig = cp.get('build', 'defconfig', raw=True)
-    self.config_file = cp.get('build', 'config_file', raw=True)
-    self.kernel_arch = cp.get('build', 'kernel_arch', raw=True)
-    self.compiler = cp.get('build', 'compiler', raw=True)
-    self.compiler_install = cp.get('build', 'compiler_install', raw=True)
-    self.jobs = cp.getint('build', 'jobs', raw=True)
-
-    self.vbutil_kernel = cp.get('build', 'vbutil_kernel', raw=True)
-    self.keyblock = cp.get('build', 'keyblock', raw=True)
-    self.data_key = cp.get('build', 'data_key', raw=True)
-    self.cmdline = cp.get('build', 'cmdline', raw=True)
-    self.vbutil_arch = cp.get('build', 'vbutil_arch', raw=True)
-
-    self.mkimage = cp.get('build', 'mkimage', raw=True)
-    self.its_file = cp.get('build', 'its_file', raw=True)
-
-    self.install_modules = cp.getboolean('build', 'install_modules')
-    self.install_dtbs = cp.getboolean('build', 'install_dtbs')
-    self.install_headers = cp.getboolean('build', 'install_headers')
-    self.generate_htmldocs = cp.getboolean('build', 'generate_htmldocs')
-    self.completion_text = cp.get('build', 'completion_text')
+               fail_on_stderr, kselftest=False, jobs=None):
+    self.spec = BuildSpec.from_file(ini_path, jobs)
 
     self.generate_pkg = generate_pkg
     self.generate_compile_db = generate_compile_db
     self.fail_on_stderr = fail_on_stderr
     self.kselftest = kselftest
 
-    if self.defconfig and self.config_file:
+    if self.spec.defconfig and self.spec.config_file:
       raise ValueError('Specifying both defconfig and config_file is invalid')
 
-    if self.defconfig:
-      postfix = self.defconfig
+    if self.spec.defconfig:
+      postfix = self.spec.defconfig
     else:
-      postfix = pathlib.PurePath(self.config_file).name
+      postfix = pathlib.PurePath(self.spec.config_file).name
 
-    if self.generate_htmldocs:
+    if self.spec.generate_htmldocs:
       prefix = 'htmldocs'
     elif self.kselftest:
       prefix = 'kselftest'
@@ -92,32 +264,60 @@ class Builder(object):
       prefix = 'build'
 
     self.output_path = pathlib.Path.cwd().joinpath(
-                          '.{}_{}-{}'.format(prefix, self.kernel_arch, postfix))
+                  '.{}_{}-{}'.format(prefix, self.spec.kernel_arch, postfix))
     if not self.output_path.is_dir():
       self.output_path.mkdir()
 
-    print('dc={} ps={} op={}'.format(self.defconfig, postfix, self.output_path))
+    print('dc={} ps={} op={}'.format(self.spec.defconfig, postfix,
+                                     self.output_path))
 
     self.packed_kernel = self.output_path.joinpath('vmlinux.kpart')
+    self._modules_staged = None
+    # (read fd, write fd) of a make jobserver shared with other Builders
+    self.jobserver = None
+
+    # Strings and make settings that are the same for every command, so they
+    # aren't rebuilt on each of the many make invocations
+    self._output_path_s = str(self.output_path)
+    self._packed_kernel_s = str(self.packed_kernel)
+
+    self._base_make_env = {}
+    self._base_make_env['ARCH'] = self.spec.kernel_arch
+    self._base_make_env['O'] = self._output_path_s
+    #self._base_make_env['EXTRA_CFLAGS'] = '-Werror'
+    if self.spec.ccache:
+      # $(CROSS_COMPILE) is left for make to expand with make.cross's value
+      if self.spec.compiler.startswith('clang'):
+        cc, hostcc = 'clang', 'clang'
+      else:
+        cc, hostcc = '$(CROSS_COMPILE)gcc', 'gcc'
+      self._base_make_env['CC'] = '{} {}'.format(self.spec.ccache, cc)
+      self._base_make_env['HOSTCC'] = '{} {}'.format(self.spec.ccache, hostcc)
 
-  def __output_thread(self, pipe, output):
-      for l in iter(pipe.readline, b''):
-        line = l.rstrip().decode('utf-8')
-        print(line)
-        if output != None:
-          output.append(line)
+    # make.cross picks the toolchain from its environment
+    self._make_proc_env = dict(os.environ)
+    self._make_proc_env['COMPILER'] = self.spec.compiler
+    self._make_proc_env['COMPILER_INSTALL_PATH'] = self.spec.compiler_install
+    if self.spec.ccache_dir:
+      self._make_proc_env['CCACHE_DIR'] = os.path.expanduser(
+                                            self.spec.ccache_dir)
 
+    _prefetch_make_cross()
 
   def prompt_user(self, prompt):
     while True:
-      reply = str(input(prompt + ' (y/n): ')).lower().strip()
+      try:
+        reply = str(input(prompt + ' (y/n): ')).lower().strip()
+      except EOFError:
+        # No one to ask (eg: a --parallel worker), so don't continue
+        return False
       if reply[0] == 'y':
         return True
       if reply[0] == 'n':
         return False
 
 
-  def __print_errors(self, prefix, errors, show_prompt):
+  def __print_errors(self, prefix, errors, show_prompt, args):
     print('***********************************************************')
     print('*')
     if errors:
@@ -134,226 +334,476 @@ class Builder(object):
       print('*')
       print('***********************************************************')
 
-  def __run_command(self, args, fail_on_stderr=False, show_prompt=True):
+  def __echo_lines(self, pipe, out):
+    # Pull whatever is available in large chunks, pass the complete lines
+    # straight through to our stdout and split them ourselves, rather than
+    # paying for a read, decode and print per line. Lines are yielded as bytes.
+    pending = b''
+    while True:
+      chunk = pipe.read1(self.pipe_chunk_size)
+      if not chunk:
+        break
+      data = pending + chunk
+      end = data.rfind(b'\n') + 1
+      if end:
+        out.write(memoryview(data)[:end])
+        out.flush()
+        yield from data[:end - 1].split(b'\n')
+      pending = data[end:]
+    if pending:
+      out.write(pending + b'\n')
+      yield pending
+
+  def __run_command(self, args, fail_on_stderr=False, show_prompt=True,
+                    posix_spawn=False, env=None, pass_fds=()):
     print('')
     print('#############################################################')
     print('#')
     print('# {}'.format(' '.join(args)))
-    print('#')
-    p = subprocess.Popen(args=args, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-
-    stdout_thread = threading.Thread(target=self.__output_thread,
-                                     args=(p.stdout, None))
-
-    stderr = []
-    stderr_thread = threading.Thread(target=self.__output_thread,
-                                     args=(p.stderr, stderr))
-
-    stdout_thread.start()
-    stderr_thread.start()
-    p.wait()
-    stdout_thread.join()
-    stderr_thread.join()
+    # stdout is only echoed, so let the child write to it directly; stderr is
+    # read back here and classified line by line as it arrives.
+    # Flush first so our own buffered output can't land after the child's.
+    print('#', flush=True)
+    popen_kwargs = {}
+    if posix_spawn:
+      # Popen only takes the posix_spawn() path if it doesn't have to close
+      # fds and the executable is given as a path
+      popen_kwargs['close_fds'] = False
+      popen_kwargs['executable'] = shutil.which(args[0]) or args[0]
+    if pass_fds:
+      popen_kwargs['pass_fds'] = pass_fds
 
-    drm_re = re.compile('(drivers/gpu/drm|include/drm|include/uapi/drm)')
     drm_stderr = []
     other_stderr = []
-    for l in stderr:
-      ignore = False
-      for r in self.stderr_ignore:
-        if r.search(l):
-          print('IGNORE: {}'. format(l))
-          ignore = True
-          break
-      if ignore:
-        continue
-      if drm_re.search(l):
-        drm_stderr.append(l)
-      else:
-        other_stderr.append(l)
-
-    self.__print_errors('DRM', drm_stderr, show_prompt)
-    self.__print_errors('KERNEL', other_stderr, False)
+    with subprocess.Popen(args=args, stderr=subprocess.PIPE, env=env,
+                          bufsize=self.pipe_chunk_size, **popen_kwargs) as p:
+      out = sys.stdout.buffer
+      for l in self.__echo_lines(p.stderr, out):
+        # Only lines that are kept for the summary get decoded
+        if self.stderr_ignore_re.search(l):
+          out.write(b'IGNORE: ' + l + b'\n')
+          continue
+        if self._drm_re.search(l):
+          drm_stderr.append(l.decode('utf-8', 'replace').rstrip())
+        else:
+          other_stderr.append(l.decode('utf-8', 'replace').rstrip())
+      out.flush()
+
+    self.__print_errors('DRM', drm_stderr, show_prompt, args)
+    self.__print_errors('KERNEL', other_stderr, False, args)
     if p.returncode != 0:
       if not self.prompt_user('Build failed, would you like to continue?'):
         raise subprocess.CalledProcessError(p.returncode, args)
+    return p.returncode == 0
+
 
+  def __run_quiet(self, args):
+    # For helpers with nothing worth streaming or classifying. stderr is left
+    # alone so failures still explain themselves.
+    print('# {}'.format(' '.join(args)), flush=True)
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL,
+                   close_fds=False,
+                   executable=shutil.which(args[0]) or args[0])
 
-  def __run_make(self, flags=[], env={}, targets=[], root=False, bear=False):
-    new_env = {}
-    new_env['ARCH'] = self.kernel_arch
-    new_env['O'] = str(self.output_path)
-    #new_env['EXTRA_CFLAGS'] = '-Werror'
+
+  def __run_make(self, flags=[], env={}, targets=[], root=False, bear=False,
+                 output_sync=True):
+    new_env = dict(self._base_make_env)
     new_env.update(env)
 
+    args = []
+    if root:
+      args.append('sudo')
+    if bear:
+      args.append('bear')
+    args.append('./make.cross')
+
+    # kernel Makefile is inconsistent with which arguments can be set as env
+    # variables, and which are cmdline assignments. So make all env cmdline
+    # assignments
+    args += ['{}={}'.format(k, v) for k, v in new_env.items()]
+    proc_env = self._make_proc_env
+    pass_fds = ()
+    make_version = _make_version()
+    if self.jobserver and make_version:
+      # Take job slots from the shared jobserver rather than our own -jN, so
+      # the limit holds across every build running at once. make < 4.2 only
+      # understands the older spelling of the option.
+      opt = '--jobserver-auth' if make_version >= (4, 2) else '--jobserver-fds'
+      proc_env = dict(proc_env)
+      proc_env['MAKEFLAGS'] = '-j {}={},{}'.format(opt, *self.jobserver)
+      pass_fds = self.jobserver
+    else:
+      args.append('-j{}'.format(self.spec.jobs))
+    if self.spec.load_avg > 0:
+      args.append('-l{}'.format(self.spec.load_avg))
+    if output_sync and _make_supports_output_sync():
+      # Group each recipe's output instead of interleaving lines from every
+      # job. 'recurse' would hold back everything Kbuild's sub-makes print
+      # until they finish, so group per target.
+      args.append('--output-sync=target')
+    args += flags
+    args += targets
+    return self.__run_command(args, fail_on_stderr=self.fail_on_stderr,
+                              env=proc_env, pass_fds=pass_fds)
+
+
+  def __gen_compile_db(self, script_loc):
+    args = [script_loc, '-d', self._output_path_s, '--log_level', 'INFO']
+
+    # It's a python script, so save an interpreter startup by running it here.
+    # Fall back to a subprocess if it can't be loaded (eg: an older kernel's
+    # python2 version)
+    try:
+      spec = importlib.util.spec_from_file_location('gen_compile_commands',
+                                                    script_loc)
+      mod = importlib.util.module_from_spec(spec)
+      spec.loader.exec_module(mod)
+      main = mod.main
+    except (ImportError, SyntaxError, AttributeError):
+      self.__run_command(args, fail_on_stderr=False, show_prompt=False,
+                         posix_spawn=True)
+      return
+
+    print('')
+    print('# {}'.format(' '.join(args)))
+    old_argv = sys.argv
+    sys.argv = args
+    # main() calls logging.basicConfig(), which now configures this process's
+    # root logger rather than a throwaway child's
     try:
-      old_env_compiler = os.environ.get('COMPILER')
-      if old_env_compiler == None:
-        old_env_compiler = ''
-      os.environ['COMPILER'] = self.compiler
-
-      old_env_compiler_path = os.environ.get('COMPILER_INSTALL_PATH')
-      if old_env_compiler_path == None:
-        old_env_compiler_path = ''
-      os.environ['COMPILER_INSTALL_PATH'] = self.compiler_install
-
-      args = []
-      if root:
-        args = ['sudo']
-      if bear:
-        args = args + ['bear']
-
-      args = args + ['./make.cross']
-
-      # kernel Makefile is inconsistent with which arguments can be set as env
-      # variables, and which are cmdline assignments. So make all env cmdline
-      # assignments
-      for k,v in new_env.items():
-        args.append('{}={}'.format(k, v))
-
-      args.append('-j{}'.format(self.jobs))
-      args = args + flags +  targets
-      self.__run_command(args, fail_on_stderr=self.fail_on_stderr)
+      main()
+    except SystemExit as e:
+      if e.code:
+        if not self.prompt_user('Build failed, would you like to continue?'):
+          raise subprocess.CalledProcessError(e.code, args)
+    except Exception as e:
+      print('{}: {}'.format(type(e).__name__, e))
+      if not self.prompt_user('Build failed, would you like to continue?'):
+        raise subprocess.CalledProcessError(1, args) from e
     finally:
-      os.environ['COMPILER'] = old_env_compiler
-      os.environ['COMPILER_INSTALL_PATH'] = old_env_compiler_path
+      sys.argv = old_argv
+
+
+  def __kconfig_deps(self):
+    # The Kconfig files the last syncconfig read, relative to the source tree,
+    # or None if there hasn't been one yet
+    cmd_path = self.output_path.joinpath('include', 'config', 'auto.conf.cmd')
+    try:
+      lines = cmd_path.read_text().splitlines()
+    except FileNotFoundError:
+      return None
+
+    deps = []
+    in_deps = False
+    for l in lines:
+      if l.startswith('deps_config :='):
+        in_deps = True
+        continue
+      if not in_deps:
+        continue
+      dep = l.strip().rstrip('\\').strip()
+      if dep:
+        deps.append(pathlib.Path(dep.replace('$(srctree)/', '')))
+      if not l.endswith('\\'):
+        break
+    return deps or None
+
+
+  def __config_stamp(self):
+    # Everything that feeds into the generated .config: the config source,
+    # the toolchain (Kconfig probes it), the kernel version and the Kconfig
+    # files. Returns None if any of those can't be found, in which case
+    # nothing is cached.
+    h = hashlib.sha256()
+    for v in (self.spec.kernel_arch, self.spec.compiler,
+              self.spec.compiler_install, self.spec.defconfig,
+              self.spec.config_file):
+      h.update('{}\0'.format(v).encode('utf-8'))
+
+    # Otherwise symbols added by a pull or branch switch would be left for
+    # syncconfig to ask about, interactively, in the middle of the build.
+    # Stat them rather than read them since there are well over a thousand.
+    kconfigs = self.__kconfig_deps()
+    if kconfigs is None:
+      return None
+    for path in kconfigs:
+      try:
+        st = path.stat()
+      except FileNotFoundError:
+        h.update('{} -\n'.format(path).encode('utf-8'))
+        continue
+      h.update('{} {} {}\n'.format(path, st.st_size,
+                                   st.st_mtime_ns).encode('utf-8'))
+
+    if self.spec.defconfig:
+      srcarch = _SRCARCH.get(self.spec.kernel_arch, self.spec.kernel_arch)
+      candidates = [
+        pathlib.Path('arch', srcarch, 'configs', self.spec.defconfig),
+        pathlib.Path('kernel', 'configs', self.spec.defconfig),
+      ]
+      config_src = next((c for c in candidates if c.is_file()), None)
+      if not config_src:
+        print('No file found for {}, configure will always run'.format(
+                self.spec.defconfig))
+        return None
+    else:
+      config_src = pathlib.Path(self.spec.config_file)
+
+    for path in (pathlib.Path('Makefile'), config_src):
+      if path.is_file():
+        h.update(path.read_bytes())
+      h.update(b'\0')
+    return h.hexdigest()
 
 
   def __configure(self):
+    stamp = self.__config_stamp()
+    stamp_path = self.output_path.joinpath('.config.stamp')
+    if (stamp and self.output_path.joinpath('.config').exists() and
+        stamp_path.exists() and stamp_path.read_text() == stamp):
+      print('Config inputs are unchanged, skipping configure')
+      return
+
+    # Only a configure that succeeded may be skipped next time
+    if stamp_path.exists():
+      stamp_path.unlink()
+
     # prefer defconfig over out-of-tree config
-    if self.defconfig:
-      self.__run_make(targets=[self.defconfig])
+    if self.spec.defconfig:
+      ok = self.__run_make(targets=[self.spec.defconfig])
     else:
-      print('Using out-of-tree config {}'.format(self.config_file))
-      config_src_path = pathlib.PosixPath(self.config_file)
+      print('Using out-of-tree config {}'.format(self.spec.config_file))
+      config_src_path = pathlib.PosixPath(self.spec.config_file)
       config_dst_path = self.output_path.joinpath('.config')
-      with config_src_path.open() as s:
-        with config_dst_path.open(mode='w') as d:
-          d.write(s.read())
-      self.__run_make(targets=['olddefconfig'])
+      shutil.copyfile(str(config_src_path), str(config_dst_path))
+      ok = self.__run_make(targets=['olddefconfig'])
+    if ok and stamp:
+      stamp_path.write_text(stamp)
 
 
   def __make(self):
     if (self.generate_pkg and
         not self.kselftest):
-      self.__run_make(targets=['bindeb-pkg'])
-    elif self.generate_htmldocs:
-      self.__run_make(targets=['htmldocs'])
+      targets = ['bindeb-pkg']
+    elif self.spec.generate_htmldocs:
+      targets = ['htmldocs']
     elif self.kselftest:
-      self.__run_make(targets=['kselftest'])
+      targets = ['kselftest']
     else:
-      self.__run_make(targets=['all'])
+      targets = ['all']
 
-    if self.install_modules:
+    # Save a second walk of the tree by building dtbs in the same make. The
+    # other targets recurse into their own sub-makes, so keep those separate.
+    if self.spec.install_dtbs and targets == ['all']:
+      targets.append('dtbs')
+    # These run syncconfig, which can stop to ask about new Kconfig symbols.
+    # Output sync would hold the question back until it's been answered.
+    self.__run_make(targets=targets, output_sync=False)
+
+    if self.spec.install_modules:
       modules_dst_path = self.output_path.joinpath('installed_modules')
       self.__run_make(env={ 'INSTALL_MOD_PATH': modules_dst_path },
                       targets=['modules_install'])
       print('Installed modules to {}'.format(modules_dst_path))
 
+      # installed_modules keeps the releases of earlier builds too, so only
+      # remember this build's for __flash to copy
+      release_path = self.output_path.joinpath('include', 'config',
+                                               'kernel.release')
+      if release_path.is_file():
+        staged = modules_dst_path.joinpath('lib', 'modules',
+                                           release_path.read_text().strip())
+        if staged.name and staged.is_dir():
+          self._modules_staged = staged
+
     if self.generate_compile_db:
         script_loc = 'scripts/gen_compile_commands.py'
         if not pathlib.Path(script_loc).exists():
             script_loc = 'scripts/clang-tools/gen_compile_commands.py'
-        self.__run_command([script_loc,
-                            '-d', str(self.output_path),
-                            '--log_level', 'INFO'], fail_on_stderr=False,
-                            show_prompt=False)
+        self.__gen_compile_db(script_loc)
 
-    if self.install_dtbs:
+    if self.spec.install_dtbs and 'dtbs' not in targets:
       self.__run_make(targets=['dtbs'])
 
-    if self.install_headers:
+    if self.spec.install_headers:
         headers_dst_path = self.output_path.joinpath('headers')
         self.__run_make(env={ 'INSTALL_HDR_PATH': headers_dst_path },
                         targets=['headers_install'])
 
 
 
+  def __package_stamp(self):
+    # Stat rather than hash the images since vmlinux can be hundreds of MB,
+    # and anything the build touched has a new mtime anyway. arch/*/boot holds
+    # the Image/zImage and dtbs that its files pull in.
+    h = hashlib.sha256()
+    settings = (self.spec.mkimage, self.spec.its_file, self.spec.vbutil_kernel,
+                self.spec.keyblock, self.spec.data_key, self.spec.cmdline,
+                self.spec.vbutil_arch)
+    h.update(repr(settings).encode('utf-8'))
+
+    inputs = [self.output_path.joinpath('vmlinux')]
+    inputs += [pathlib.Path(p) for p in (self.spec.its_file,
+                                         self.spec.keyblock,
+                                         self.spec.data_key) if p]
+    srcarch = _SRCARCH.get(self.spec.kernel_arch, self.spec.kernel_arch)
+    boot = self.output_path.joinpath('arch', srcarch, 'boot')
+    inputs += sorted(boot.rglob('*'))
+    for path in inputs:
+      try:
+        st = path.stat()
+      except FileNotFoundError:
+        continue
+      h.update('{} {} {}\n'.format(path, st.st_size,
+                                   st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
   def __package(self):
-    if not self.mkimage:
+    if not self.spec.mkimage:
       return
 
     uimg = self.output_path.joinpath('vmlinux.uimg')
-    self.__run_command([
-      self.mkimage,
+    packed = self.packed_kernel if self.spec.vbutil_kernel else uimg
+    stamp = self.__package_stamp()
+    stamp_path = self.output_path.joinpath('.package.stamp')
+    if (packed.exists() and stamp_path.exists() and
+        stamp_path.read_text() == stamp):
+      print('Kernel images are unchanged, skipping packaging')
+      return
+
+    # Only packaging that succeeded may be skipped next time
+    if stamp_path.exists():
+      stamp_path.unlink()
+    if self.__pack_images(uimg):
+      stamp_path.write_text(stamp)
+
+
+  def __pack_images(self, uimg):
+    ok = self.__run_command([
+      self.spec.mkimage,
        '-D', '""-I dts -O dtb -p 2048""',
-       '-f', self.its_file,
+       '-f', self.spec.its_file,
        str(uimg)
-    ])
+    ], posix_spawn=True)
 
-    if not self.vbutil_kernel:
-      return
+    if not self.spec.vbutil_kernel:
+      return ok
 
     zero = self.output_path.joinpath('zero.bin')
-    self.__run_command([
-      'dd',
-      'if=/dev/zero',
-      'of={}'.format(str(zero)),
-      'bs=512',
-      'count=1'
-    ])
+    zero.write_bytes(b'\x00' * 512)
 
     cmdline = self.output_path.joinpath('cmdline')
     with cmdline.open('w') as f:
-      f.write(self.cmdline)
+      f.write(self.spec.cmdline)
 
-    self.__run_command([
-      self.vbutil_kernel,
-      '--pack', str(self.packed_kernel),
+    return self.__run_command([
+      self.spec.vbutil_kernel,
+      '--pack', self._packed_kernel_s,
       '--version', '1',
       '--vmlinuz', str(uimg),
-      '--arch', self.vbutil_arch,
-      '--keyblock', self.keyblock,
-      '--signprivate', self.data_key,
+      '--arch', self.spec.vbutil_arch,
+      '--keyblock', self.spec.keyblock,
+      '--signprivate', self.spec.data_key,
       '--config', str(cmdline),
-      '--bootloader', str(zero)])
+      '--bootloader', str(zero)], posix_spawn=True) and ok
+
+
+  def __wait_for_block_device(self, dev):
+    if dev.is_block_device():
+      return
+
+    print('Insert your USB key...')
+    if not pyudev:
+      while not dev.is_block_device():
+        time.sleep(2)
+      return
+
+    # Block on udev events rather than polling. The timeout covers a device
+    # which showed up before the monitor was started.
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    monitor.filter_by('block')
+    monitor.start()
+    while not dev.is_block_device():
+      monitor.poll(timeout=2)
 
 
   def __flash(self):
-    if not self.kernel_part_uuid:
+    if not self.spec.kernel_part_uuid:
       return
 
-    path = '/dev/disk/by-partuuid/{}'.format(self.kernel_part_uuid)
+    path = '/dev/disk/by-partuuid/{}'.format(self.spec.kernel_part_uuid)
     kernel_part = pathlib.Path(path)
-    if not kernel_part.is_block_device():
-      print('Insert your USB key...')
-      while not kernel_part.is_block_device():
-        time.sleep(2)
+    self.__wait_for_block_device(kernel_part)
 
-    # Flash kernel to USB drive
+    # Flash kernel to USB drive. dd's default 512 byte blocks make this take
+    # far longer than the device needs, and conv=fsync replaces a global sync
     self.__run_command([
       'sudo',
       'dd',
-      'if={}'.format(str(self.packed_kernel)),
-      'of={}'.format(str(kernel_part))])
-    self.__run_command(['sync'])
+      'if={}'.format(self._packed_kernel_s),
+      'of={}'.format(str(kernel_part)),
+      'bs=4M',
+      'oflag=direct',
+      'conv=fsync'], posix_spawn=True)
 
-    if not self.root_uuid:
+    if not self.spec.root_uuid:
       return
 
-    # Copy modules to rootfs
-    root = pathlib.Path('/dev/disk/by-uuid/{}'.format(self.root_uuid))
-    if not root.is_block_device():
-      print('Insert your USB key...')
-      while not kernel_part.is_block_device():
-        time.sleep(2)
+    # Copy modules and dtbs to rootfs. Reuse the modules_install tree from
+    # __make and stage the dtbs next to it, so nothing has to be built as root.
+    dtbs_dst_path = None
+    if self.spec.install_dtbs:
+      dtbs_dst_path = self.output_path.joinpath('installed_dtbs')
+      # Start empty so dtbs dropped since an earlier build aren't copied too
+      if dtbs_dst_path.exists():
+        shutil.rmtree(str(dtbs_dst_path))
+      self.__run_make(env={ 'INSTALL_DTBS_PATH': dtbs_dst_path },
+                      targets=['dtbs_install'])
+
+    root = pathlib.Path('/dev/disk/by-uuid/{}'.format(self.spec.root_uuid))
+    self.__wait_for_block_device(root)
 
     with tempfile.TemporaryDirectory() as mount_pt:
-      self.__run_command([
+      self.__run_quiet([
         'sudo',
         'mount',
-        'UUID={}'.format(self.root_uuid),
+        'UUID={}'.format(self.spec.root_uuid),
         mount_pt])
       try:
-        if self.install_modules:
+        if self.spec.install_modules and self._modules_staged:
+          # Copy into <mount>/lib/modules rather than merging a tree onto the
+          # mount root, so the path resolves through lib -> usr/lib on a
+          # merged-/usr rootfs. Like modules_install, drop the release's old
+          # kernel/ dir first but leave any out-of-tree modules alone.
+          modules_root = os.path.join(mount_pt, 'lib', 'modules')
+          self.__run_quiet(['sudo', 'mkdir', '-p', modules_root])
+          self.__run_quiet([
+            'sudo',
+            'rm',
+            '-rf',
+            os.path.join(modules_root, self._modules_staged.name, 'kernel')])
+          self.__run_quiet([
+            'sudo',
+            'cp',
+            '-R',
+            '--preserve=mode,timestamps',
+            str(self._modules_staged),
+            modules_root])
+        elif self.spec.install_modules:
           self.__run_make(env={ 'INSTALL_MOD_PATH': mount_pt },
                           targets=['modules_install'], root=True)
-        if self.install_dtbs:
-          self.__run_make(env={ 'INSTALL_DTBS_PATH': mount_pt },
-                          targets=['dtbs_install'], root=True)
+        if dtbs_dst_path:
+          self.__run_quiet([
+            'sudo',
+            'cp',
+            '-R',
+            '--preserve=mode,timestamps',
+            '{}/.'.format(dtbs_dst_path),
+            mount_pt])
       finally:
-        self.__run_command([
+        self.__run_quiet([
           'sudo',
           'umount',
           mount_pt])
@@ -361,12 +811,7 @@ class Builder(object):
 
   def do_build(self):
     try:
-      repo = 'https://raw.githubusercontent.com/intel/lkp-tests/'
-      url = repo + 'master/sbin/make.cross'
-      urllib.request.urlretrieve(url, 'make.cross')
-
-      st = os.stat('make.cross')
-      os.chmod('make.cross', st.st_mode | stat.S_IEXEC)
+      _prefetch_make_cross().result()
 
       self.__configure()
       self.__make()
@@ -375,14 +820,17 @@ class Builder(object):
           self.__package()
           self.__flash()
 
-      if self.completion_text:
-          print(self.completion_text)
+      if self.spec.completion_text:
+          print(self.spec.completion_text)
 
     finally:
       #os.unlink('make.cross')
       print('Finished')
 
 
+def _run_one(builder):
+  builder.do_build()
+
 def main():
   parser = argparse.ArgumentParser(description='Build a kernel')
   parser.add_argument('--config', help='Optional build config path override',
@@ -396,13 +844,57 @@ def main():
                       help='Do a kselftest build')
   parser.add_argument('--nofail_on_stderr', default=False, action='store_false',
                       help='Fail command on stderr')
+  parser.add_argument('--jobs', type=int,
+                      help='Override the number of make jobs from the config')
+  parser.add_argument('--parallel', default=False, action='store_true',
+                      help='Build multiple --config entries concurrently. '
+                           'Prompts are answered no, and configs which flash '
+                           'a kernel_part_uuid are rejected')
   args = parser.parse_args()
 
-  for c in args.config:
-    builder = Builder(c, not args.skip_gen_compile_db, args.gen_pkg,
-                      not args.nofail_on_stderr,
-                      args.kselftest)
-    builder.do_build()
+  parallel = args.parallel and len(args.config) > 1
+  if parallel:
+    # Workers have no stdin to answer prompts with, nor should several builds
+    # wait on USB keys at once. Checked before the Builders set anything up.
+    flashing = [c for c in args.config
+                if BuildSpec.from_file(c, args.jobs).kernel_part_uuid]
+    if flashing:
+      parser.error('--parallel cannot flash kernels: {}'.format(
+                     ', '.join(flashing)))
+
+  builders = [Builder(c, not args.skip_gen_compile_db, args.gen_pkg,
+                      not args.nofail_on_stderr, args.kselftest,
+                      args.jobs)
+              for c in args.config]
+
+  if parallel:
+    # Finish the fetch up front so the workers don't race on the download
+    _prefetch_make_cross().result()
+
+    # Every build's make shares one jobserver, so between them they run at
+    # most total_jobs jobs. Each make also holds one implicit job slot of its
+    # own, so only the remainder go in the pipe as tokens. Each spec's jobs
+    # already reflects --jobs or the config's jobs=.
+    total_jobs = max(b.spec.jobs for b in builders)
+    if _make_version():
+      workers = min(len(builders), total_jobs)
+      jobserver = os.pipe()
+      os.write(jobserver[1], b'+' * (total_jobs - workers))
+      for builder in builders:
+        builder.jobserver = jobserver
+    else:
+      # Without a jobserver each make runs its own -jN, so only run as many
+      # builds at once as the CPUs can take
+      workers = max(1, min(len(builders), _default_jobs() // total_jobs))
+
+    # Workers must be forked to inherit the jobserver fds
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=ctx) as ex:
+      list(ex.map(_run_one, builders))
+  else:
+    for builder in builders:
+      builder.do_build()
 
 if __name__ == '__main__':
   main()